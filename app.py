@@ -8,13 +8,26 @@ from flask import session
 from my_log import log
 from functools import wraps
 from flask import jsonify
+from flask import Response
+from flask import stream_with_context
 
+from models import db
 from models import User
 from models import Blog
 from models import Comment
 from models import Follow
+from models import BucketMoving
+from models import query_for_id
+from models import query_for_user
+from models import remove_shard_sessions
 from time_filter import formatted_time
+from rate_limit import rate_limited
+from rate_limit import shed_counts
+from sqlalchemy import or_
+from sqlalchemy import and_
 
+import io
+import csv
 import json
 
 app = Flask(__name__)
@@ -22,6 +35,23 @@ app.secret_key = 'peng'
 admin = 1
 
 
+# 请求结束的时候把分片的 session 还回去
+@app.teardown_request
+def shard_teardown(exception):
+    remove_shard_sessions()
+
+
+# 要写的博客正在被搬到别的分片, 让客户端稍后重试
+@app.errorhandler(BucketMoving)
+def bucket_moving(e):
+    r = jsonify({
+        'result': '数据正在迁移, 请稍后再试',
+    })
+    r.status_code = 503
+    r.headers['Retry-After'] = '1'
+    return r
+
+
 # 通过 session 来获取当前登录的用户
 def current_user():
     try:
@@ -118,6 +148,7 @@ def register_view():
 
 # 处理注册的请求  POST
 @app.route('/register', methods=['POST'])
+@rate_limited
 def register():
     d = request.get_json()
     form = d
@@ -191,8 +222,8 @@ def timeline_view(username):
         # 找不到就返回 404, 这是 flask 的默认 404 用法
         abort(404)
     log('看个人主页')
-    blogs = u.blogs
-    blogs.sort(key=lambda t: t.created_time, reverse=True)
+    # 只查列表要用的列, 正文是 deferred 的不会被读出来
+    blogs = query_for_user(Blog, u.id).filter_by(user_id=u.id).order_by(Blog.created_time.desc()).all()
     fan_follow_count(u)
     fans_id_list = get_fan(user_now.id)
     d = dict(
@@ -209,7 +240,7 @@ def timeline_view(username):
 @requires_login
 def blog_view(blog_id):
     user_now = current_user()
-    blog = Blog.query.filter_by(id=blog_id).first()
+    blog = query_for_id(Blog, blog_id).filter_by(id=blog_id).first()
     comments = blog.comments
     comments.sort(key=lambda t: t.created_time, reverse=True)
     blog_comments = []
@@ -241,10 +272,11 @@ def blog_add_view():
 # 处理 写博客 的请求 POST
 @app.route('/blog/add', methods=['POST'])
 @requires_login
+@rate_limited
 def blog_add():
     user_now = current_user()
     blog = Blog(request.form)
-    blog.user = user_now
+    blog.user_id = user_now.id
     blog.save()
     log('发布成功')
     return redirect(url_for('timeline_view', username=user_now.username))
@@ -253,6 +285,7 @@ def blog_add():
 # 处理 发送 评论的函数  POST
 @app.route('/comment/add', methods=['POST'])
 @requires_login
+@rate_limited
 def comment_add():
     log('发送评论')
     user_now = current_user()
@@ -262,11 +295,11 @@ def comment_add():
     blog_id = form.get('blog_id', '')
     # 设置是谁发的
     c.sender_name = user_now.username
-    c.blog = Blog.query.filter_by(id=blog_id).first()
+    c.blog = query_for_id(Blog, blog_id).filter_by(id=blog_id).first()
     # 保存到数据库
     c.save()
     blog = c.blog
-    blog.com_count = len(Comment.query.filter_by(blog_id=blog.id).all())
+    blog.com_count = query_for_id(Comment, blog.id).filter_by(blog_id=blog.id).count()
     blog.save()
     log('写评论')
     status = {
@@ -280,20 +313,138 @@ def comment_add():
     return r
 
 
+# 用户列表可以按这几列排序
+user_sort_columns = {
+    'created_time': User.created_time,
+    'fan_count': User.fan_count,
+    'role': User.role,
+}
+# 用户列表每页显示的数量
+users_per_page = 20
+# 导出用户的时候导出这几列
+user_export_columns = ['id', 'username', 'sex', 'role', 'follow_count', 'fan_count', 'created_time']
+# 导出用户的时候每次从数据库读多少行
+user_export_chunk = 1000
+
+
+# 用户列表只认这几个参数, 翻页和导出的链接也只带上这几个
+def user_list_args(args):
+    d = {}
+    for k in ('prefix', 'sort', 'order'):
+        if k in args:
+            d[k] = args[k]
+    return d
+
+
+# 根据 url 参数得到用户列表的排序列和方向
+def users_sort(args):
+    column = user_sort_columns.get(args.get('sort', ''), User.created_time)
+    asc = args.get('order', '') == 'asc'
+    return column, asc
+
+
+# 根据 url 参数得到用户列表的查询, 排序和过滤都在数据库里做
+def users_query(args):
+    query = User.query
+    prefix = args.get('prefix', '')
+    if prefix != '':
+        # 用范围查询代替 like, 这样可以用上 username 的索引
+        query = query.filter(User.username >= prefix, User.username < prefix + '\U0010ffff')
+    column, asc = users_sort(args)
+    if asc:
+        query = query.order_by(column.asc(), User.id.asc())
+    else:
+        query = query.order_by(column.desc(), User.id.desc())
+    return query
+
+
 # 显示 用户列表 的界面 GET
 @app.route('/users/list')
 @requires_login
 def users_view():
     user_now = current_user()
-    all_users = User.query.all()
+    args = user_list_args(request.args)
+    page = max(request.args.get('page', 1, type=int), 1)
+    pagination = users_query(args).paginate(page, users_per_page, False)
     log('看所有用户')
     d = dict(
         user_now=user_now,
-        all_users=all_users,
+        all_users=pagination.items,
+        pagination=pagination,
+        args=args,
     )
     return render_template('all_users.html', **d)
 
 
+# 按块读出要导出的用户, 每块是一个单独的短查询
+# 下一块从上一块最后一行的 (排序列, id) 之后接着读, 不用 offset, 也不会一直占着读锁
+def export_user_rows(args):
+    column, asc = users_sort(args)
+    columns = [getattr(User, x) for x in user_export_columns]
+    sort_index = user_export_columns.index(column.key)
+    id_index = user_export_columns.index('id')
+    last = None
+    while True:
+        query = users_query(args).with_entities(*columns)
+        if last is not None:
+            value, id = last
+            if asc:
+                after = or_(column > value, and_(column == value, User.id > id))
+            else:
+                after = or_(column < value, and_(column == value, User.id < id))
+            query = query.filter(after)
+        rows = query.limit(user_export_chunk).all()
+        # 结束这次读, 两块之间写请求可以拿到锁
+        db.session.commit()
+        for row in rows:
+            yield row
+        if len(rows) < user_export_chunk:
+            break
+        last = rows[-1][sort_index], rows[-1][id_index]
+
+
+def export_csv_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(user_export_columns)
+    for row in rows:
+        writer.writerow(row)
+        # 攒够一批再发出去, 内存里始终只有一小段数据
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_json_rows(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(user_export_columns, row)), ensure_ascii=False) + '\n'
+
+
+# 导出 用户列表 GET
+# format 可以是 csv 或者 jsonl, 过滤和排序的参数和用户列表一样
+@app.route('/users/export')
+def users_export():
+    user_now = current_user()
+    if user_now is None or user_now.role != admin:
+        abort(401)
+    # 只查需要的列, 并且一次只从数据库取一批, 不会把所有用户都读进内存
+    rows = export_user_rows(user_list_args(request.args))
+    log('导出用户')
+    if request.args.get('format', '') == 'jsonl':
+        body = export_json_rows(rows)
+        mimetype = 'application/x-ndjson'
+        filename = 'users.jsonl'
+    else:
+        body = export_csv_rows(rows)
+        mimetype = 'text/csv'
+        filename = 'users.csv'
+    r = Response(stream_with_context(body), mimetype=mimetype)
+    r.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    return r
+
+
 # 显示 编辑用户 的界面 GET
 @app.route('/user/update/<user_id>')
 def user_update_view(user_id):
@@ -341,7 +492,7 @@ def user_delete(user_id):
 @requires_login
 def blog_update_view(blog_id):
     user_now = current_user()
-    blog = Blog.query.filter_by(id=blog_id).first()
+    blog = query_for_id(Blog, blog_id).filter_by(id=blog_id).first()
     d = dict(
         user_now=user_now,
         blog=blog,
@@ -353,7 +504,7 @@ def blog_update_view(blog_id):
 @app.route('/blog/update/<blog_id>', methods=['POST'])
 @requires_login
 def blog_update(blog_id):
-    blog = Blog.query.filter_by(id=blog_id).first()
+    blog = query_for_id(Blog, blog_id).filter_by(id=blog_id).first()
     blog.update(request.form)
     blog.save()
     return redirect(url_for('blog_view', blog_id=blog_id))
@@ -364,7 +515,7 @@ def blog_update(blog_id):
 @requires_login
 def blog_delete(blog_id):
     user_now = current_user()
-    blog = Blog.query.filter_by(id=blog_id).first()
+    blog = query_for_id(Blog, blog_id).filter_by(id=blog_id).first()
     blog.delete()
     return redirect(url_for('timeline_view', username=user_now.username))
 
@@ -411,6 +562,7 @@ def fan_view(user_id):
 # 处理 关注用户 的请求 GET
 @app.route('/follow/<user_id>')
 @requires_login
+@rate_limited
 def follow_act(user_id):
     user_now = current_user()
     u = User.query.filter_by(id=user_id).first()
@@ -441,8 +593,8 @@ def unfollow_act(user_id):
 @requires_login
 def reply_view(comment_id):
     user_now = current_user()
-    comment = Comment.query.filter_by(id=comment_id).first()
-    all_comments = Comment.query.filter_by(reply_id=comment_id).all()
+    comment = query_for_id(Comment, comment_id).filter_by(id=comment_id).first()
+    all_comments = query_for_id(Comment, comment_id).filter_by(reply_id=comment_id).all()
     user = User.query.filter_by(username=comment.sender_name).first()
     all_comments.sort(key=lambda t: t.created_time, reverse=True)
     log('查看回复')
@@ -457,21 +609,31 @@ def reply_view(comment_id):
 
 # 处理 回复评论 的页面 POST
 @app.route('/reply/add/<comment_id>', methods=['POST'])
+@rate_limited
 def reply_act(comment_id):
     user_now = current_user()
     c = Comment(request.form)
     c.sender_name = user_now.username
     c.reply_id = comment_id
-    comment = Comment.query.filter_by(id=comment_id).first()
+    comment = query_for_id(Comment, comment_id).filter_by(id=comment_id).first()
     c.blog_id = comment.blog.id
     c.save()
     blog = c.blog
-    blog.com_count = len(Comment.query.filter_by(blog_id=blog.id).all())
+    blog.com_count = query_for_id(Comment, blog.id).filter_by(blog_id=blog.id).count()
     blog.save()
     log('回复评论成功')
     return redirect(url_for('reply_view', comment_id=comment_id))
 
 
+# 显示 被限流拒绝的请求计数 GET
+@app.route('/admin/shed')
+def shed_view():
+    user_now = current_user()
+    if user_now is None or user_now.role != admin:
+        abort(401)
+    return jsonify(shed_counts())
+
+
 if __name__ == '__main__':
     host, port = '0.0.0.0', 5000
     args = {
@@ -0,0 +1,68 @@
+# 比较 1 个分片和 N 个分片时发博客的写入吞吐
+# 在临时目录里建库, 不会动工程目录下的数据库
+# 用法: python bench_shard.py [分片数] [进程数] [每个进程写多少条]
+from my_log import log
+
+import os
+import sys
+import time
+import random
+import tempfile
+import multiprocessing
+
+import models
+
+
+def use_dir(path):
+    models.db_path = os.path.join(path, 'db.sqlite')
+    models.shard_path_format = os.path.join(path, 'blog_{}.sqlite')
+    models.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(models.db_path)
+
+
+# 丢掉已经打开的数据库连接
+# fork 出来的进程不能用父进程的连接, 换了目录之后也不能用旧的连接
+def reset():
+    models.remove_shard_sessions()
+    models.shard_sessions.clear()
+    models.db.session.remove()
+    models.db.get_engine(models.app).dispose()
+
+
+def writer(seed, users, count):
+    reset()
+    random.seed(seed)
+    for i in range(count):
+        b = models.Blog(dict(title='bench', content='x' * 2000))
+        b.user_id = random.randint(1, users)
+        b.save()
+        models.remove_shard_sessions()
+
+
+def run(shards, workers, count, users=1000):
+    with tempfile.TemporaryDirectory() as path:
+        use_dir(path)
+        models.shard_count = shards
+        reset()
+        models.rebuild_db()
+        ps = [multiprocessing.Process(target=writer, args=(i, users, count)) for i in range(workers)]
+        start = time.time()
+        for p in ps:
+            p.start()
+        for p in ps:
+            p.join()
+        used = time.time() - start
+        reset()
+    return workers * count / used
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    shards, workers, count = args + [4, 8, 200][len(args):]
+    multiprocessing.set_start_method('fork')
+    for n in (1, shards):
+        rate = run(n, workers, count)
+        log('{} 个分片, {} 个进程: {:.0f} 条/秒'.format(n, workers, rate))
+
+
+if __name__ == '__main__':
+    main()
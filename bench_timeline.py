@@ -0,0 +1,77 @@
+# 比较个人主页的博客列表 只读摘要 和 连正文一起读 的耗时和内存
+# 在临时目录里建库, 不会动工程目录下的数据库
+# 用法: python bench_timeline.py [博客数] [每篇博客的字节数] [重复次数]
+from my_log import log
+from bench_shard import use_dir
+from bench_shard import reset
+from sqlalchemy.orm import undefer_group
+
+import sys
+import time
+import random
+import string
+import tempfile
+import tracemalloc
+
+import models
+
+
+def seed(blogs, size):
+    models.rebuild_db()
+    s = models.shard_session(models.shard_of_bucket(models.bucket_of_user(1)))
+    # 随机的正文才能看出压缩前后的真实大小, 这里用单词拼出来, 比较接近真实文章
+    words = [''.join(random.choice(string.ascii_lowercase) for i in range(6)) for j in range(500)]
+    for i in range(blogs):
+        content = ' '.join(random.choice(words) for j in range(size // 7))
+        b = models.Blog(dict(title='blog {}'.format(i), content=content))
+        b.user_id = 1
+        models.shard_add(b, models.bucket_of_user(1), 'blog_seq')
+    s.commit()
+    models.remove_shard_sessions()
+
+
+def timeline(with_body):
+    query = models.query_for_user(models.Blog, 1).filter_by(user_id=1)
+    if with_body:
+        # 以前的主页会把正文一起读出来
+        query = query.options(undefer_group('body'))
+    blogs = query.order_by(models.Blog.created_time.desc()).all()
+    for b in blogs:
+        if with_body:
+            b.content
+        else:
+            b.excerpt
+    return blogs
+
+
+# 计时和统计内存分开做, tracemalloc 会拖慢速度
+def measure(with_body, rounds):
+    start = time.time()
+    for i in range(rounds):
+        models.remove_shard_sessions()
+        timeline(with_body)
+    used = (time.time() - start) / rounds
+    models.remove_shard_sessions()
+    tracemalloc.start()
+    blogs = timeline(with_body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del blogs
+    return used * 1000, peak / 1024
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    blogs, size, rounds = args + [500, 8 * 1024, 20][len(args):]
+    with tempfile.TemporaryDirectory() as path:
+        use_dir(path)
+        reset()
+        seed(blogs, size)
+        for with_body, name in ((False, '只读摘要'), (True, '连正文一起读')):
+            ms, kb = measure(with_body, rounds)
+            log('{} 篇 {} 字节的博客, {}: {:.1f} 毫秒, 内存峰值 {:.0f} KB'.format(blogs, size, name, ms, kb))
+        reset()
+
+
+if __name__ == '__main__':
+    main()
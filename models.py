@@ -1,14 +1,38 @@
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 from sqlalchemy import sql
+from sqlalchemy import event
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm import undefer_group
 from my_log import log
 
+import os
+import glob
+import heapq
+import re
 import time
-import shutil
+import zlib
+import sqlite3
 import hashlib
 
+# 数据库文件都放在工程目录下
+# flask-sqlalchemy 会把相对路径当成相对工程目录, 其他直接打开文件的地方也要一致
+base_path = os.path.dirname(os.path.abspath(__file__))
 # 数据库的路径
-db_path = 'db.sqlite'
+# db.sqlite 是目录库, 放 users、follows 和 桶到分片的路由表
+db_path = os.path.join(base_path, 'db.sqlite')
+# blogs 和 comments 写得最多, 按用户分到多个分片文件里
+# 这样不同用户发博客和评论的时候不会抢同一把写锁
+shard_path_format = os.path.join(base_path, 'blog_{}.sqlite')
+# 新建数据库时的分片数量, 已有数据库要改分片数量用 python models.py reshard N
+shard_count = 4
+# 虚拟桶的数量, 定下来之后就不能再改了
+# 用户 id 除以它的余数就是用户所在的桶, 一个桶里的博客和评论总是在同一个分片
+# 博客和评论的 id 除以它的余数也是所在的桶, 所以只凭 id 就能找到分片
+bucket_count = 64
 # 获取 app 的实例
 app = Flask(__name__)
 # 这个先不管，其实是 flask 用来加密 session 的东西
@@ -30,6 +54,138 @@ def convert_to_sha1(pwd):
         return hashlib.sha1(pwd.encode('utf-8')).hexdigest()
 
 
+# 博客正文超过这么多字节就压缩了再存
+zip_threshold = 1024
+# 摘要的长度
+excerpt_length = 100
+
+
+def make_excerpt(content):
+    text = ' '.join(content.split())
+    if len(text) > excerpt_length:
+        text = text[:excerpt_length] + '...'
+    return text
+
+
+# 要写的桶正在被搬到别的分片, 过一会儿重试就好
+class BucketMoving(Exception):
+    pass
+
+
+# 每个分片一个 session, 按线程隔离, 请求结束的时候调用 remove_shard_sessions
+shard_sessions = {}
+
+
+def shard_path(shard):
+    return shard_path_format.format(shard)
+
+
+def set_wal(conn, record):
+    conn.execute('PRAGMA journal_mode=WAL')
+
+
+def shard_session(shard):
+    if shard not in shard_sessions:
+        engine = create_engine('sqlite:///{}'.format(shard_path(shard)))
+        # 用 WAL 模式, 读分片的时候不会挡住写
+        event.listen(engine, 'connect', set_wal)
+        shard_sessions.setdefault(shard, scoped_session(sessionmaker(bind=engine)))
+    return shard_sessions[shard]()
+
+
+def remove_shard_sessions():
+    for s in shard_sessions.values():
+        s.remove()
+
+
+def bucket_of_user(user_id):
+    return int(user_id) % bucket_count
+
+
+# 博客和评论的 id 都能算出它在哪个桶
+def bucket_of_id(id):
+    return int(id) % bucket_count
+
+
+def shard_of_bucket(bucket):
+    return Bucket.query.filter_by(id=bucket).first().shard
+
+
+# 得到 查某个用户的博客 的 query
+def query_for_user(model, user_id):
+    s = shard_session(shard_of_bucket(bucket_of_user(user_id)))
+    return s.query(model)
+
+
+# 得到 按博客或评论 id 查询 的 query, 这个 id 所在分片里的数据都能查到
+def query_for_id(model, id):
+    s = shard_session(shard_of_bucket(bucket_of_id(id)))
+    return s.query(model)
+
+
+# 现在用到的所有分片
+def all_shards():
+    return sorted(set(x.shard for x in Bucket.query.all()))
+
+
+# 跨分片查询博客, 每个分片各查一次再按时间合并
+# user_ids 是 None 的时候查所有用户的
+def gather_blogs(user_ids=None, limit=20):
+    if user_ids is None:
+        shards = {x: None for x in all_shards()}
+    else:
+        shards = {}
+        for i in user_ids:
+            shard = shard_of_bucket(bucket_of_user(i))
+            shards.setdefault(shard, []).append(i)
+    results = []
+    for shard, ids in shards.items():
+        query = shard_session(shard).query(Blog)
+        if ids is not None:
+            query = query.filter(Blog.user_id.in_(ids))
+        blogs = query.order_by(Blog.created_time.desc()).limit(limit).all()
+        results.append(blogs)
+    merged = heapq.merge(*results, key=lambda t: -t.created_time)
+    return list(merged)[:limit]
+
+
+# 写分片之前先执行这一步
+# 它是一条 UPDATE, 会先拿到分片的写锁, 和搬桶的操作互斥
+# 桶不在这个分片或者正在搬的时候一行都改不到, 就抛出 BucketMoving
+# seq 是 blog_seq 或者 comment_seq 的时候顺便分配一个新的 id
+def fence(session, bucket, seq=None):
+    if seq is None:
+        update = 'UPDATE shard_buckets SET moving = 0 WHERE bucket = :bucket AND moving = 0'
+    else:
+        update = 'UPDATE shard_buckets SET {0} = {0} + 1 WHERE bucket = :bucket AND moving = 0'.format(seq)
+    r = session.execute(update, dict(bucket=bucket))
+    if r.rowcount != 1:
+        session.rollback()
+        raise BucketMoving(bucket)
+    if seq is not None:
+        select = 'SELECT {} FROM shard_buckets WHERE bucket = :bucket'.format(seq)
+        n = session.execute(select, dict(bucket=bucket)).scalar()
+        return n * bucket_count + bucket
+
+
+# 把博客或评论加到分片的 session 里, 新的数据会分配一个编码了桶的 id
+def shard_add(m, bucket, seq):
+    s = object_session(m) or shard_session(shard_of_bucket(bucket))
+    if m.id is None:
+        m.id = fence(s, bucket, seq)
+    else:
+        fence(s, bucket)
+    s.add(m)
+    return s
+
+
+def shard_delete(m, bucket):
+    s = object_session(m)
+    fence(s, bucket)
+    s.delete(m)
+    s.commit()
+
+
 # 数据库里面的一张表，是一个类
 # 它继承自 db.Model
 class User(db.Model):
@@ -37,16 +193,15 @@ class User(db.Model):
     # 这些都是内置的 __tablename__ 是表名
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String())
+    # 用户列表要按用户名前缀过滤, 按下面几列排序, 所以都加上索引
+    username = db.Column(db.String(), index=True)
     password = db.Column(db.String())
     sex = db.Column(db.String())
     note = db.Column(db.String(), nullable=True)
-    role = db.Column(db.Integer, default=2)
+    role = db.Column(db.Integer, default=2, index=True)
     follow_count = db.Column(db.Integer, default=0)
-    fan_count = db.Column(db.Integer, default=0)
-    created_time = db.Column(db.INTEGER, default=0)
-    # 这是引用别的表的数据的属性，表明了它关联的东西
-    blogs = db.relationship('Blog', backref='user')
+    fan_count = db.Column(db.Integer, default=0, index=True)
+    created_time = db.Column(db.INTEGER, default=0, index=True)
 
     def __init__(self, form):
         super(User, self).__init__()
@@ -85,7 +240,17 @@ class User(db.Model):
         else:
             return False
 
+    # 先删分片里这个用户的博客和评论, 再删 db.sqlite 里的用户
+    # 两个文件没办法放在一个事务里, 如果删用户这一步失败了
+    # 用户还在但是博客已经没了, 再删一次就行
     def delete(self):
+        bucket = bucket_of_user(self.id)
+        s = shard_session(shard_of_bucket(bucket))
+        fence(s, bucket)
+        blog_ids = s.query(Blog.id).filter_by(user_id=self.id)
+        s.query(Comment).filter(Comment.blog_id.in_(blog_ids)).delete(synchronize_session=False)
+        s.query(Blog).filter_by(user_id=self.id).delete(synchronize_session=False)
+        s.commit()
         db.session.delete(self)
         db.session.commit()
 
@@ -100,15 +265,28 @@ class User(db.Model):
             return True
 
 
+# blogs 和 comments 在分片文件里, 要用 query_for_user 和 query_for_id 来查
+# 不能用 Blog.query 和 Comment.query
 class Blog(db.Model):
     __tablename__ = 'blogs'
+    __bind_key__ = 'shards'
+    # 个人主页按 user_id 查、按 created_time 排序, 有这个索引就不用扫整个分片
+    __table_args__ = (
+        db.Index('ix_blogs_user_id_created_time', 'user_id', 'created_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String())
-    content = db.Column(db.String())
+    # 正文可能很长, 列表页用不到, 所以设置成 deferred
+    # 只有真正访问 blog.content 的时候才会去数据库读, 两列放在一个 group 里一次读出来
+    # 正文比较长的时候压缩后存在 zipped_content 里, content 列留空
+    _content = db.deferred(db.Column('content', db.String()), group='body')
+    zipped_content = db.deferred(db.Column(db.LargeBinary, nullable=True), group='body')
+    # 正文的摘要, 给列表页预览用
+    excerpt = db.Column(db.String(), default='', server_default='')
     created_time = db.Column(db.INTEGER, default=0)
     com_count = db.Column(db.Integer, default=0)
-    # 这是一个外键
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # users 在另一个文件里, 所以不能是外键
+    user_id = db.Column(db.Integer)
     comments = db.relationship('Comment', backref='blog')
 
     def __init__(self, form):
@@ -120,13 +298,33 @@ class Blog(db.Model):
         class_name = self.__class__.__name__
         return u'<{}: {}>'.format(class_name, self.id)
 
+    @property
+    def content(self):
+        if self.zipped_content is not None:
+            return zlib.decompress(self.zipped_content).decode('utf-8')
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        data = content.encode('utf-8')
+        if len(data) >= zip_threshold:
+            self.zipped_content = zlib.compress(data)
+            self._content = ''
+        else:
+            self.zipped_content = None
+            self._content = content
+        self.excerpt = make_excerpt(content)
+
+    @property
+    def user(self):
+        return User.query.filter_by(id=self.user_id).first()
+
     def save(self):
-        db.session.add(self)
-        db.session.commit()
+        s = shard_add(self, bucket_of_user(self.user_id), 'blog_seq')
+        s.commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        shard_delete(self, bucket_of_id(self.id))
 
     def update(self, form):
         self.title = form.get('title', '')
@@ -137,12 +335,13 @@ class Blog(db.Model):
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __bind_key__ = 'shards'
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String())
     created_time = db.Column(db.INTEGER, default=0)
     sender_name = db.Column(db.String())
     reply_id = db.Column(db.Integer, default=0)
-    blog_id = db.Column(db.Integer, db.ForeignKey('blogs.id'))
+    blog_id = db.Column(db.Integer, db.ForeignKey('blogs.id'), index=True)
 
     def __init__(self, form):
         self.content = form.get('content', '')
@@ -152,13 +351,16 @@ class Comment(db.Model):
         class_name = self.__class__.__name__
         return u'<{}: {}>'.format(class_name, self.id)
 
+    # 评论和它的博客在同一个桶里
+    # 只设置了 comment.blog 的时候 blog_id 要等 flush 才有, 所以先看 blog
     def save(self):
-        db.session.add(self)
-        db.session.commit()
+        if self.blog is not None:
+            self.blog_id = self.blog.id
+        s = shard_add(self, bucket_of_id(self.blog_id), 'comment_seq')
+        s.commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        shard_delete(self, bucket_of_id(self.id))
 
 
 class Follow(db.Model):
@@ -188,19 +390,282 @@ class Follow(db.Model):
         db.session.commit()
 
 
+# 桶到分片的路由表, 在 db.sqlite 里
+class Bucket(db.Model):
+    __tablename__ = 'buckets'
+    # 桶的编号
+    id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.Integer)
+
+
+# 每个分片里有哪些桶, 以及这个桶分配到的最大 id
+# moving 为 1 表示这个桶正在搬走, 不能再写
+shard_buckets = db.Table(
+    'shard_buckets',
+    db.Column('bucket', db.Integer, primary_key=True),
+    db.Column('moving', db.Integer, default=0),
+    db.Column('blog_seq', db.Integer, default=0),
+    db.Column('comment_seq', db.Integer, default=0),
+    info={'bind_key': 'shards'},
+)
+shard_tables = [Blog.__table__, Comment.__table__, shard_buckets]
+
+
+def create_shard(shard):
+    engine = shard_session(shard).get_bind()
+    db.metadata.create_all(engine, tables=shard_tables)
+
+
+# 磁盘上已有的分片文件的编号
+def existing_shards():
+    pattern = re.escape(shard_path_format).replace(re.escape('{}'), r'(\d+)') + '$'
+    shards = []
+    for path in glob.glob(shard_path_format.format('*')):
+        m = re.match(pattern, path)
+        if m is not None:
+            shards.append(int(m.group(1)))
+    return sorted(shards)
+
+
+# 分片是 WAL 模式, 最新的数据可能还在 -wal 文件里
+# 所以用 sqlite 的 backup 接口来备份, 不直接复制文件
 def backup_db():
-    backup_path = '{}.{}'.format(time.time(), db_path)
-    shutil.copyfile(db_path, backup_path)
+    paths = [db_path] + [shard_path(x) for x in existing_shards()]
+    for path in paths:
+        if os.path.exists(path):
+            name = '{}.{}'.format(time.time(), os.path.basename(path))
+            backup_path = os.path.join(os.path.dirname(path), name)
+            src = sqlite3.connect(path)
+            dst = sqlite3.connect(backup_path)
+            try:
+                src.backup(dst)
+            finally:
+                src.close()
+                dst.close()
+
+
+# 重建分片, 把桶平均分到 shard_count 个分片里
+def rebuild_shards():
+    for i in range(shard_count):
+        engine = shard_session(i).get_bind()
+        db.metadata.drop_all(engine, tables=shard_tables)
+        db.metadata.create_all(engine, tables=shard_tables)
+    Bucket.query.delete()
+    for bucket in range(bucket_count):
+        shard = bucket % shard_count
+        db.session.add(Bucket(id=bucket, shard=shard))
+        shard_session(shard).execute(shard_buckets.insert(), dict(bucket=bucket))
+    db.session.commit()
+    for i in range(shard_count):
+        shard_session(i).commit()
 
 
 def rebuild_db():
     backup_db()
     db.drop_all()
     db.create_all()
+    rebuild_shards()
     log('rebuild database')
 
 
+# 把老的 db.sqlite 里面的 blogs 和 comments 搬到分片里
+# 老数据的 id 里没有桶的信息, 所以会重新分配 id, 评论的 blog_id 和 reply_id 也跟着改
+# 要停服执行. 全部搬完并提交之后才会删掉老的表
+# 中途出错的话直接重新运行, 分片会被重建, 老数据还在
+def migrate_to_shards():
+    backup_db()
+    db.create_all()
+    rebuild_shards()
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        blog_ids = {}
+        if 'blogs' in tables:
+            cursor = conn.execute(
+                'SELECT id, title, content, created_time, com_count, user_id FROM blogs ORDER BY id'
+            )
+            for i, row in enumerate(cursor):
+                old_id, title, content, created_time, com_count, user_id = row
+                if user_id is None:
+                    continue
+                b = Blog(dict(title=title, content=content or ''))
+                b.created_time = created_time
+                b.com_count = com_count
+                b.user_id = user_id
+                shard_add(b, bucket_of_user(user_id), 'blog_seq')
+                blog_ids[old_id] = b.id
+                if i % 1000 == 999:
+                    commit_shards()
+            commit_shards()
+        comment_ids = {}
+        if 'comments' in tables:
+            cursor = conn.execute(
+                'SELECT id, content, created_time, sender_name, reply_id, blog_id FROM comments ORDER BY id'
+            )
+            for i, row in enumerate(cursor):
+                old_id, content, created_time, sender_name, reply_id, blog_id = row
+                if blog_id not in blog_ids:
+                    continue
+                c = Comment(dict(content=content))
+                c.created_time = created_time
+                c.sender_name = sender_name
+                c.reply_id = comment_ids.get(reply_id, 0)
+                c.blog_id = blog_ids[blog_id]
+                shard_add(c, bucket_of_id(c.blog_id), 'comment_seq')
+                comment_ids[old_id] = c.id
+                if i % 1000 == 999:
+                    commit_shards()
+            commit_shards()
+        conn.execute('DROP TABLE IF EXISTS comments')
+        conn.execute('DROP TABLE IF EXISTS blogs')
+        conn.commit()
+    finally:
+        conn.close()
+    log('migrate database to shards')
+
+
+def commit_shards():
+    for s in shard_sessions.values():
+        s.commit()
+        s.expunge_all()
+
+
+# 把一个桶搬到另一个分片, 搬的时候其他桶照常读写
+# 1. 在旧分片里把桶标记成 moving, 这一步会等正在写这个桶的请求完成, 之后的写入都会失败
+# 2. 把桶里的博客、评论和 id 计数复制到新分片, 一个事务提交
+# 3. 改 db.sqlite 里的路由, 之后的读写都去新分片
+# 4. 删掉旧分片里的数据
+# 中途出错的话桶会一直不能写, 重新运行 reshard 就能接着搬完
+def move_bucket(bucket, to_shard):
+    b = Bucket.query.filter_by(id=bucket).first()
+    if b.shard == to_shard:
+        return
+    old = shard_session(b.shard)
+    new = shard_session(to_shard)
+    params = dict(bucket=bucket)
+    old.execute('UPDATE shard_buckets SET moving = 1 WHERE bucket = :bucket', params)
+    old.commit()
+    row = old.execute(shard_buckets.select().where(shard_buckets.c.bucket == bucket)).first()
+    new.execute(shard_buckets.insert().prefix_with('OR REPLACE'), dict(
+        bucket=bucket,
+        moving=0,
+        blog_seq=row.blog_seq,
+        comment_seq=row.comment_seq,
+    ))
+    for table in (Blog.__table__, Comment.__table__):
+        cursor = old.execute(table.select().where(table.c.id % bucket_count == bucket))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            new.execute(table.insert().prefix_with('OR REPLACE'), [dict(x) for x in rows])
+    new.commit()
+    b.shard = to_shard
+    db.session.commit()
+    purge_bucket(old, bucket)
+    log('搬桶', bucket, '到分片', to_shard)
+
+
+def purge_bucket(session, bucket):
+    for table in (Comment.__table__, Blog.__table__):
+        session.execute(table.delete().where(table.c.id % bucket_count == bucket))
+    session.execute(shard_buckets.delete().where(shard_buckets.c.bucket == bucket))
+    session.commit()
+
+
+# 把所有桶重新平均分到 n 个分片里, 不用停服
+# 搬完之后记得把 shard_count 改成 n
+def reshard(n):
+    for i in range(n):
+        create_shard(i)
+    for bucket in range(bucket_count):
+        move_bucket(bucket, bucket % n)
+    # 清理上次中途失败留下的数据: 标记了 moving 但路由已经指向别的分片的桶
+    routes = {x.id: x.shard for x in Bucket.query.all()}
+    for shard in existing_shards():
+        s = shard_session(shard)
+        rows = s.execute(shard_buckets.select().where(shard_buckets.c.moving == 1)).fetchall()
+        for row in rows:
+            if routes[row.bucket] != shard:
+                purge_bucket(s, row.bucket)
+    log('reshard', n)
+
+
+# 给老的 users 表补上索引
+def upgrade_user_db():
+    conn = sqlite3.connect(db_path)
+    try:
+        for column in ('username', 'role', 'fan_count', 'created_time'):
+            sql = 'CREATE INDEX IF NOT EXISTS ix_users_{0} ON users ({0})'.format(column)
+            conn.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+    log('upgrade user database')
+
+
+# 给老的 blogs 表加上 zipped_content 和 excerpt 两列, 补上主页和评论要用的索引
+# 然后把已有的长博客压缩, 顺便生成摘要
+def upgrade_blog_db():
+    # 先检查所有分片都有 blogs 表, 有一个不对就什么都不改
+    for shard in all_shards():
+        path = shard_path(shard)
+        if not os.path.exists(path):
+            log('找不到分片', path, '请先运行 python models.py migrate')
+            return
+        conn = sqlite3.connect(path)
+        try:
+            exists = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='blogs'"
+            ).fetchone()
+        finally:
+            conn.close()
+        if exists is None:
+            log('分片', path, '里没有 blogs 表, 请先运行 python models.py migrate')
+            return
+    backup_db()
+    for shard in all_shards():
+        conn = sqlite3.connect(shard_path(shard))
+        try:
+            columns = [x[1] for x in conn.execute('PRAGMA table_info(blogs)')]
+            if 'zipped_content' not in columns:
+                conn.execute('ALTER TABLE blogs ADD COLUMN zipped_content BLOB')
+            if 'excerpt' not in columns:
+                conn.execute("ALTER TABLE blogs ADD COLUMN excerpt VARCHAR DEFAULT ''")
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_blogs_user_id_created_time ON blogs (user_id, created_time)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_comments_blog_id ON comments (blog_id)')
+            conn.commit()
+        finally:
+            conn.close()
+        s = shard_session(shard)
+        query = s.query(Blog).options(undefer_group('body'))
+        last_id = 0
+        while True:
+            blogs = query.filter(Blog.id > last_id).order_by(Blog.id).limit(100).all()
+            if not blogs:
+                break
+            for b in blogs:
+                b.content = b.content or ''
+            s.commit()
+            last_id = blogs[-1].id
+    log('upgrade blog database')
+
+
 # 第一次运行工程的时候没有数据库
 # 所以我们运行 models.py 创建一个新的数据库文件
+# 已经有老数据库的话, 运行 python models.py migrate 把博客和评论搬到分片里
+# 运行 python models.py reshard N 把数据重新分到 N 个分片里
+# 运行 python models.py upgrade 给用户表加索引, 给博客表加上压缩正文和摘要
 if __name__ == '__main__':
-    rebuild_db()
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        migrate_to_shards()
+    elif sys.argv[1:2] == ['reshard'] and len(sys.argv) == 3:
+        reshard(int(sys.argv[2]))
+    elif sys.argv[1:] == ['upgrade']:
+        upgrade_user_db()
+        upgrade_blog_db()
+    else:
+        rebuild_db()
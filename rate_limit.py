@@ -0,0 +1,281 @@
+from flask import request
+from flask import session
+from flask import jsonify
+from my_log import log
+from functools import wraps
+from contextlib import contextmanager
+
+import os
+import time
+import math
+import random
+import sqlite3
+import threading
+
+# 限流状态存在一个单独的 sqlite 文件里
+# 这样多个 worker 进程看到的是同一份令牌桶和写入名额, 而且不会去抢 db.sqlite 的写锁
+# 和 models.py 一样放在工程目录下, 不管 worker 从哪个目录启动都用同一个文件
+limit_db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rate_limit.sqlite')
+# 准入检查等 rate_limit.sqlite 写锁的最长秒数, 超过就当作服务太忙直接拒绝
+lock_timeout = 1
+# 拒绝请求时顺带的写入 (退令牌、删排队记录、计数) 只等这么久, 拿不到锁就算了
+side_timeout = 0.05
+# 每次取令牌时有这么大的概率顺便清理长时间没用过的桶
+bucket_cleanup_rate = 0.01
+# 令牌桶的容量, 也就是允许的突发请求数
+bucket_capacity = 10
+# 每秒往桶里补充的令牌数
+refill_rate = 1.0
+# 所有进程加起来同时允许进入写接口的请求数
+max_writers = 4
+# 所有进程加起来最多允许多少个请求排队等写入名额, 队伍满了就直接拒绝
+max_waiters = 16
+# 拿不到写入名额时最多等待的秒数, 超过就直接拒绝
+writer_wait = 0.5
+# 排队的时候隔多久看一次有没有空出来的名额
+writer_poll = 0.02
+# 写入名额最多占用的秒数, 进程崩溃没有归还的名额过了这个时间会被收回
+writer_lease = 30
+# 因为写入名额不够被拒绝时, 建议客户端多少秒后重试
+busy_retry_after = 1
+
+# 每个线程复用一个连接
+local = threading.local()
+# 因为限流数据库被锁住而拒绝的请求没法写进数据库, 只在当前进程里计数
+locked_count = 0
+locked_count_lock = threading.Lock()
+
+
+# 打开连接, 顺便建表, 每个线程只会执行一次
+def connect():
+    conn = sqlite3.connect(limit_db_path, timeout=lock_timeout, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL,
+        updated_time REAL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_buckets_updated_time ON buckets (updated_time)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS shed_counts (
+        reason TEXT PRIMARY KEY,
+        count INTEGER
+    )''')
+    # kind 是 writer 表示占着一个写入名额, 是 waiter 表示正在排队
+    # id 是按到达顺序分配的, 排队的请求按 id 从小到大拿名额
+    conn.execute('''CREATE TABLE IF NOT EXISTS slots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        expire_time REAL
+    )''')
+    return conn
+
+
+# 得到当前线程的连接
+# fork 出来的子进程不能用父进程的连接, 所以顺便记下是哪个进程打开的
+def connection():
+    pid = os.getpid()
+    if getattr(local, 'pid', None) != pid:
+        local.conn = connect()
+        local.pid = pid
+    return local.conn
+
+
+# 拿到写锁执行一段读改写, 多个进程之间是原子的
+# timeout 是等写锁的最长秒数
+@contextmanager
+def transaction(timeout=lock_timeout):
+    conn = connection()
+    conn.execute('PRAGMA busy_timeout = {}'.format(int(timeout * 1000)))
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+# 用当前登录用户的 id 作为限流的 key, 没登录就用 ip
+def client_key():
+    user_id = session.get('user_id')
+    if user_id is not None:
+        return 'user:{}'.format(user_id)
+    return 'ip:{}'.format(request.remote_addr)
+
+
+# 从 key 对应的桶里取一个令牌
+# 取到了返回 0, 取不到返回需要等待的秒数
+def take_token(key):
+    now = time.time()
+    with transaction() as conn:
+        row = conn.execute(
+            'SELECT tokens, updated_time FROM buckets WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            tokens = bucket_capacity
+        else:
+            tokens, updated_time = row
+            tokens = min(bucket_capacity, tokens + (now - updated_time) * refill_rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / refill_rate
+        conn.execute(
+            'INSERT OR REPLACE INTO buckets (key, tokens, updated_time) VALUES (?, ?, ?)',
+            (key, tokens, now),
+        )
+        # 这么久没用过的桶肯定已经补满了, 删掉和留着效果一样
+        # 不删的话每个出现过的用户和 ip 都会留下一行
+        if random.random() < bucket_cleanup_rate:
+            idle = bucket_capacity / refill_rate
+            conn.execute('DELETE FROM buckets WHERE updated_time < ?', (now - idle,))
+    return wait
+
+
+# 把令牌还回去, 请求因为写入名额不够被拒绝的时候用
+def refund_token(key):
+    with transaction(side_timeout) as conn:
+        conn.execute(
+            'UPDATE buckets SET tokens = min(?, tokens + 1) WHERE key = ?',
+            (bucket_capacity, key),
+        )
+
+
+def count_slots(conn, kind):
+    row = conn.execute('SELECT count(*) FROM slots WHERE kind = ?', (kind,)).fetchone()
+    return row[0]
+
+
+def add_slot(conn, kind, expire_time):
+    cursor = conn.execute(
+        'INSERT INTO slots (kind, expire_time) VALUES (?, ?)', (kind, expire_time)
+    )
+    return cursor.lastrowid
+
+
+def remove_slot(slot_id, timeout=lock_timeout):
+    with transaction(timeout) as conn:
+        conn.execute('DELETE FROM slots WHERE id = ?', (slot_id,))
+
+
+def first_waiter(conn):
+    row = conn.execute("SELECT min(id) FROM slots WHERE kind = 'waiter'").fetchone()
+    return row[0]
+
+
+# 申请一个写入名额
+# 没人排队的时候有空名额就直接拿, 有人排队就先排到队尾, 空出来的名额按先来后到给排队的请求
+# 成功返回 (名额 id, None), 失败返回 (None, 被拒绝的原因)
+def acquire_writer():
+    deadline = time.time() + writer_wait
+    waiter_id = None
+    try:
+        while True:
+            now = time.time()
+            with transaction() as conn:
+                conn.execute('DELETE FROM slots WHERE expire_time < ?', (now,))
+                free = count_slots(conn, 'writer') < max_writers
+                first = first_waiter(conn)
+                if free and (first is None or first == waiter_id):
+                    if waiter_id is not None:
+                        conn.execute('DELETE FROM slots WHERE id = ?', (waiter_id,))
+                        waiter_id = None
+                    slot_id = add_slot(conn, 'writer', now + writer_lease)
+                    return slot_id, None
+                if waiter_id is None:
+                    if count_slots(conn, 'waiter') >= max_waiters:
+                        return None, 'queue'
+                    # 排队的请求过了 deadline 就不会再来拿名额, 所以记录很快就会过期
+                    waiter_id = add_slot(conn, 'waiter', deadline + 1)
+            if now >= deadline:
+                return None, 'busy'
+            time.sleep(writer_poll)
+    finally:
+        if waiter_id is not None:
+            try:
+                remove_slot(waiter_id, side_timeout)
+            except sqlite3.OperationalError as e:
+                # 删不掉也没关系, 过了 expire_time 会被清理
+                log('删除排队记录失败', e)
+
+
+# 记录一次被拒绝的请求
+# 计数失败不影响拒绝请求本身
+# 限流数据库被锁住的时候再去写它只会更慢, 所以 locked 只记在当前进程里
+def count_shed(reason):
+    global locked_count
+    if reason == 'locked':
+        with locked_count_lock:
+            locked_count += 1
+        return
+    try:
+        with transaction(side_timeout) as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO shed_counts (reason, count) VALUES (?, 0)', (reason,)
+            )
+            conn.execute(
+                'UPDATE shed_counts SET count = count + 1 WHERE reason = ?', (reason,)
+            )
+    except sqlite3.OperationalError as e:
+        log('拒绝计数失败', reason, e)
+
+
+# 得到 被拒绝请求的计数, 是一个 reason 到次数的字典
+# locked 是当前进程的计数, 其他的是所有进程加起来的
+def shed_counts():
+    rows = connection().execute('SELECT reason, count FROM shed_counts').fetchall()
+    d = dict(rows)
+    d['locked'] = locked_count
+    return d
+
+
+def too_many_requests(reason, retry_after):
+    count_shed(reason)
+    retry_after = max(1, int(math.ceil(retry_after)))
+    log('拒绝请求', reason, request.path)
+    r = jsonify({
+        'result': '请求太频繁, 请稍后再试',
+        'reason': reason,
+    })
+    r.status_code = 429
+    r.headers['Retry-After'] = str(retry_after)
+    return r
+
+
+# 写接口的准入控制
+# 先按用户或 ip 做令牌桶限流, 再限制所有进程同时写入的请求数
+# 因为写入名额不够被拒绝的请求会把令牌还回去, 限流数据库被锁住的时候就不还了
+def rate_limited(f):
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        key = client_key()
+        try:
+            wait = take_token(key)
+        except sqlite3.OperationalError as e:
+            # 限流数据库本身的锁等太久了, 说明压力很大, 同样拒绝
+            log('限流数据库繁忙', e)
+            return too_many_requests('locked', busy_retry_after)
+        if wait > 0:
+            return too_many_requests('rate', wait)
+        try:
+            slot_id, reason = acquire_writer()
+        except sqlite3.OperationalError as e:
+            log('限流数据库繁忙', e)
+            slot_id, reason = None, 'locked'
+        if slot_id is None:
+            if reason != 'locked':
+                try:
+                    refund_token(key)
+                except sqlite3.OperationalError as e:
+                    log('归还令牌失败', e)
+            return too_many_requests(reason, busy_retry_after)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            try:
+                remove_slot(slot_id)
+            except sqlite3.OperationalError as e:
+                # 没还上的名额过了 writer_lease 会被收回
+                log('归还写入名额失败', e)
+    return wrapped